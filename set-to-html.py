@@ -20,10 +20,12 @@ Key features:
 from __future__ import annotations
 
 import argparse
+import functools
+import io
 import os
 import re
 from dataclasses import dataclass
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Tuple, Optional
 
 
 # --------------------------
@@ -36,6 +38,8 @@ BEGIN_PROBLEM_RE = re.compile(r"\\begin\{problem\*?\}")
 END_PROBLEM_RE = re.compile(r"\\end\{problem\*?\}")
 BEGIN_ENV_RE = re.compile(r"\\begin\{([a-zA-Z*]+)\}")
 END_ENV_RE = re.compile(r"\\end\{([a-zA-Z*]+)\}")
+# Next \section{ (group 1) or \begin{problem}/\begin{problem*} (group 2: env name)
+SECTION_OR_PROBLEM_RE = re.compile(r"(\\section\{)|\\begin\{(problem\*?)\}")
 
 MATH_BLOCK_ENVS = {
     "equation", "equation*",
@@ -54,9 +58,41 @@ LABEL_RE = re.compile(r"\\label\{([^}]+)\}")
 REF_RE = re.compile(r"\\ref\{([^}]+)\}")
 SET_TEX_RE = re.compile(r"^set\d+\.tex$")
 
+# TeX comment: an unescaped % through end of line
+COMMENT_RE = re.compile(r"(?<!\\)%[^\n]*")
+
 # Match \input{foo} and \input foo
 INPUT_RE = re.compile(r"""\\input\s*(\{([^}]+)\}|([^\s%]+))""")
 
+# Escaped pairs and the delimiters that matter for balancing; everything else
+# is skipped by the regex engine.
+BALANCE_TOKEN_RES = {
+    "{": re.compile(r"\\.|[{}]", re.DOTALL),
+    "[": re.compile(r"\\.|[\[\]]", re.DOTALL),
+}
+CONTROL_SEQ_RE = re.compile(r"\\(?:[^\W\d_]+|.)?", re.DOTALL)
+WHITESPACE_RE = re.compile(r"\s*")
+
+
+def match_balanced(s: str, pos: int, open_ch: str = "{", close_ch: str = "}") -> Optional[int]:
+    r"""
+    Given s[pos] == open_ch, return the index just past the matching close_ch,
+    or None if it is never closed. Escaped characters (\{, \}) are skipped.
+    """
+    if pos >= len(s) or s[pos] != open_ch:
+        return None
+    depth = 0
+    for m in BALANCE_TOKEN_RES[open_ch].finditer(s, pos):
+        tok = m.group(0)
+        if tok == open_ch:
+            depth += 1
+        elif tok == close_ch:
+            depth -= 1
+            if depth == 0:
+                return m.end()
+    return None
+
+
 def html_escape_content(s: str) -> str:
     # Escape content that will appear as text (including TeX for MathJax).
     # Do NOT escape quotes; leave them alone.
@@ -65,6 +101,26 @@ def html_escape_content(s: str) -> str:
              .replace(">", "&gt;"))
 
 
+# Generated HTML tags are carried through the LaTeX passes wrapped in these
+# sentinels, so the final escape pass can tell them apart from source text.
+TAG_START = "\x00"
+TAG_END = "\x01"
+MARKED_HTML_RE = re.compile(r"\x00([^\x01]*)\x01|[&<>]")
+HTML_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+
+
+def mark_tag(tag: str) -> str:
+    return TAG_START + tag + TAG_END
+
+
+def finish_marked_html(s: str) -> str:
+    # Escape text and unwrap sentinel-marked tags in a single pass.
+    def repl(m: re.Match) -> str:
+        tag = m.group(1)
+        return tag if tag is not None else HTML_ESCAPES[m.group(0)]
+    return MARKED_HTML_RE.sub(repl, s)
+
+
 def replace_tex_dashes(s: str) -> str:
     # Convert TeX-style dashes to Unicode en/em dashes.
     # This avoids entities being rendered literally by downstream HTML sanitizers.
@@ -73,28 +129,34 @@ def replace_tex_dashes(s: str) -> str:
 
 def strip_comments(tex: str) -> str:
     # Remove TeX comments: everything after an unescaped %
-    out_lines = []
-    for line in tex.splitlines():
-        i = 0
-        while True:
-            j = line.find("%", i)
-            if j == -1:
-                out_lines.append(line)
-                break
-            # if escaped \%
-            if j > 0 and line[j - 1] == "\\":
-                i = j + 1
-                continue
-            out_lines.append(line[:j])
-            break
-    return "\n".join(out_lines)
+    return COMMENT_RE.sub("", tex)
 
 
 def read_text(path: str) -> str:
+    return _read_text_abs(os.path.abspath(path))
+
+
+@functools.lru_cache(maxsize=None)
+def _read_text_abs(path: str) -> str:
+    # Shared files (e.g. preamble.tex) are read once per run, not once per set.
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
 
+_stripped_cache: dict[str, str] = {}
+
+
+def read_stripped(path: str) -> str:
+    # Comment-stripped file contents, keyed by real path so every \input of a
+    # shared file reuses a single strip_comments pass.
+    key = os.path.realpath(path)
+    text = _stripped_cache.get(key)
+    if text is None:
+        text = strip_comments(read_text(key))
+        _stripped_cache[key] = text
+    return text
+
+
 def resolve_inputs(tex: str, base_dir: str, seen: Optional[set] = None) -> str:
     r"""
     Recursively inline \\input{...} files.
@@ -122,18 +184,12 @@ def resolve_inputs(tex: str, base_dir: str, seen: Optional[set] = None) -> str:
             return f"\n% (missing input file: {fname2})\n"
 
         seen.add(path)
-        content = read_text(path)
-        content = strip_comments(content)
+        content = read_stripped(path)
         content = resolve_inputs(content, os.path.dirname(path), seen)
         return "\n" + content + "\n"
 
-    # Expand until no more \input occurrences (in case inputs introduce more inputs)
-    prev = None
-    cur = tex
-    while prev != cur:
-        prev = cur
-        cur = INPUT_RE.sub(repl, cur)
-    return cur
+    # repl already expands nested inputs, so a single pass suffices.
+    return INPUT_RE.sub(repl, tex)
 
 
 def first_digits_from_filename(path: str) -> int:
@@ -159,82 +215,86 @@ def find_set_tex_files(base_dir: str) -> List[str]:
 # Math delimiter conversion
 # --------------------------
 
-def convert_dollar_math_to_paren_bracket(tex: str) -> str:
-    r"""
-    Convert:
-      $$...$$ -> \[...\]
-      $...$   -> \(...\)
-    while respecting:
-      - escaped \$ (ignored)
-      - existing \( \) and \[ \] remain
-      - do not convert inside \verb (not handled) or verbatim (not handled)
-    This is a best-effort converter appropriate for typical homework sets.
-    """
-    s = tex
-    out = []
-    i = 0
-    n = len(s)
-    in_inline = False
-    in_display = False
+# Tokens that matter for math splitting. Escaped pairs (\$, \\, \( ...) are
+# single tokens, so an escaped character never opens or closes math.
+MATH_TOKEN_RE = re.compile(r"\\begin\{([a-zA-Z*]+)\}|\\.|\$", re.DOTALL)
+MATH_OPENERS = {r"\(": (r"\)", "inline"), r"\[": (r"\]", "display")}
+# Cheap substring checks that rule out any math in a fragment
+MATH_HINTS = ("$", r"\(", r"\[") + tuple(
+    sorted({"\\begin{" + env.rstrip("*") for env in MATH_BLOCK_ENVS})
+)
 
-    while i < n:
-        ch = s[i]
 
-        # Handle escaped dollars
-        if ch == "\\" and i + 1 < n and s[i + 1] == "$":
-            out.append("\\$")
-            i += 2
+def tokenize_math(tex: str) -> Iterator[Tuple[str, int, int]]:
+    r"""
+    Split tex into ("text" | "inline" | "display", start, end) spans in one pass.
+    Recognizes $...$, $$...$$, \(...\), \[...\] and display math environments
+    (align, equation, ...). Math spans exclude their delimiters, except that
+    environments are kept whole, so the caller emits uniform \( \) / \[ \].
+    An unmatched opener turns the rest of the input into text.
+    """
+    # Most fragments (titles, plain sentences) contain no math at all
+    if not any(hint in tex for hint in MATH_HINTS):
+        if tex:
+            yield ("text", 0, len(tex))
+        return
+
+    text_start = 0
+    skip_to = 0
+    closer = None  # delimiter that ends the current math span, if any
+    kind = ""
+    open_start = open_end = 0
+
+    for m in MATH_TOKEN_RE.finditer(tex):
+        pos = m.start()
+        if pos < skip_to:
             continue
+        tok = m.group(0)
 
-        # If we see $$ toggle display math
-        if ch == "$" and i + 1 < n and s[i + 1] == "$":
-            if in_display:
-                out.append(r"\]")
-                in_display = False
-            else:
-                out.append(r"\[")
-                in_display = True
-            i += 2
+        if closer is None:
+            env = m.group(1)
+            if env is not None:
+                if env not in MATH_BLOCK_ENVS:
+                    continue
+                try:
+                    end_pos = find_matching_env(tex, pos, env)
+                except ValueError:
+                    continue
+                end = end_env_pattern(env).match(tex, end_pos).end()
+                if pos > text_start:
+                    yield ("text", text_start, pos)
+                yield ("display", pos, end)
+                text_start = skip_to = end
+            elif tok == "$":
+                if tex.startswith("$", pos + 1):
+                    closer, kind, open_end = "$$", "display", pos + 2
+                    skip_to = open_end
+                else:
+                    closer, kind, open_end = "$", "inline", pos + 1
+                open_start = pos
+            elif tok in MATH_OPENERS:
+                closer, kind = MATH_OPENERS[tok]
+                open_start, open_end = pos, m.end()
             continue
 
-        # Single $ toggles inline math, but only if not in display mode
-        if ch == "$" and not in_display:
-            if in_inline:
-                out.append(r"\)")
-                in_inline = False
-            else:
-                out.append(r"\(")
-                in_inline = True
-            i += 1
+        # Inside math: only the matching closer matters
+        if closer == "$$":
+            if tok != "$" or not tex.startswith("$", pos + 1):
+                continue
+            close_end = pos + 2
+        elif tok == closer:
+            close_end = m.end()
+        else:
             continue
 
-        out.append(ch)
-        i += 1
+        if open_start > text_start:
+            yield ("text", text_start, open_start)
+        yield (kind, open_end, pos)
+        text_start = skip_to = close_end
+        closer = None
 
-    return "".join(out)
-
-
-def wrap_math_environments_in_brackets(tex: str) -> str:
-    r"""
-    Wrap display math environments in \[ ... \] if they aren't already.
-    E.g. \begin{align}...\end{align} becomes \[\begin{align}...\end{align}\]
-    """
-    def repl(match: re.Match) -> str:
-        env = match.group(1)
-        body = match.group(2)
-        if env in MATH_BLOCK_ENVS:
-            return r"\[" + f"\\begin{{{env}}}" + body + f"\\end{{{env}}}" + r"\]"
-        return match.group(0)
-
-    # Use a DOTALL env capture
-    pattern = re.compile(r"\\begin\{([a-zA-Z*]+)\}(.*?)\\end\{\1\}", re.DOTALL)
-    # Apply repeatedly to handle nested envs carefully (best effort)
-    prev = None
-    cur = tex
-    while prev != cur:
-        prev = cur
-        cur = pattern.sub(repl, cur)
-    return cur
+    if text_start < len(tex):
+        yield ("text", text_start, len(tex))
 
 
 # --------------------------
@@ -247,48 +307,16 @@ def extract_newcommand_blocks(tex: str) -> Tuple[List[str], str]:
     using a lightweight parser. Returns (list_of_macro_defs, tex_with_macros_removed).
     """
     def skip_ws(s: str, pos: int) -> int:
-        while pos < len(s) and s[pos].isspace():
-            pos += 1
-        return pos
+        return WHITESPACE_RE.match(s, pos).end()
 
     def parse_control_sequence(s: str, pos: int) -> Optional[int]:
-        if pos >= len(s) or s[pos] != "\\":
-            return None
-        pos += 1
-        if pos >= len(s):
-            return pos
-        if s[pos].isalpha():
-            while pos < len(s) and s[pos].isalpha():
-                pos += 1
-            return pos
-        # Single-char control sequence like \{
-        return pos + 1
-
-    def parse_balanced(s: str, pos: int, open_ch: str, close_ch: str) -> Optional[int]:
-        if pos >= len(s) or s[pos] != open_ch:
-            return None
-        depth = 1
-        pos += 1
-        while pos < len(s) and depth > 0:
-            c = s[pos]
-            if c == "\\" and pos + 1 < len(s):
-                pos += 2
-                continue
-            if c == open_ch:
-                depth += 1
-            elif c == close_ch:
-                depth -= 1
-            pos += 1
-        return pos if depth == 0 else None
+        m = CONTROL_SEQ_RE.match(s, pos)
+        return m.end() if m else None
 
     def find_unescaped(s: str, pos: int, ch: str) -> int:
-        while pos < len(s):
-            if s[pos] == "\\" and pos + 1 < len(s):
-                pos += 2
-                continue
-            if s[pos] == ch:
-                return pos
-            pos += 1
+        for m in BALANCE_TOKEN_RES[ch].finditer(s, pos):
+            if m.group(0) == ch:
+                return m.start()
         return -1
 
     macros: List[str] = []
@@ -315,7 +343,7 @@ def extract_newcommand_blocks(tex: str) -> Tuple[List[str], str]:
             j = skip_ws(tex, j)
             # macro name
             if j < n and tex[j] == "{":
-                end = parse_balanced(tex, j, "{", "}")
+                end = match_balanced(tex, j, "{", "}")
                 j = end if end is not None else j
             else:
                 end = parse_control_sequence(tex, j)
@@ -323,12 +351,12 @@ def extract_newcommand_blocks(tex: str) -> Tuple[List[str], str]:
             j = skip_ws(tex, j)
             # operator text
             if j < n and tex[j] == "{":
-                end = parse_balanced(tex, j, "{", "}")
+                end = match_balanced(tex, j, "{", "}")
                 j = end if end is not None else j
         elif cmd in (r"\newcommand", r"\renewcommand"):
             # macro name (either {..} or control sequence)
             if j < n and tex[j] == "{":
-                end = parse_balanced(tex, j, "{", "}")
+                end = match_balanced(tex, j, "{", "}")
                 j = end if end is not None else j
             else:
                 end = parse_control_sequence(tex, j)
@@ -336,16 +364,16 @@ def extract_newcommand_blocks(tex: str) -> Tuple[List[str], str]:
             j = skip_ws(tex, j)
             # optional [n] and [default]
             if j < n and tex[j] == "[":
-                end = parse_balanced(tex, j, "[", "]")
+                end = match_balanced(tex, j, "[", "]")
                 j = end if end is not None else j
                 j = skip_ws(tex, j)
                 if j < n and tex[j] == "[":
-                    end = parse_balanced(tex, j, "[", "]")
+                    end = match_balanced(tex, j, "[", "]")
                     j = end if end is not None else j
                     j = skip_ws(tex, j)
             # definition body
             if j < n and tex[j] == "{":
-                end = parse_balanced(tex, j, "{", "}")
+                end = match_balanced(tex, j, "{", "}")
                 j = end if end is not None else j
         elif cmd == r"\def":
             # \def\foo#1{...}
@@ -353,7 +381,7 @@ def extract_newcommand_blocks(tex: str) -> Tuple[List[str], str]:
             j = end if end is not None else j
             brace_pos = find_unescaped(tex, j, "{")
             if brace_pos != -1:
-                end = parse_balanced(tex, brace_pos, "{", "}")
+                end = match_balanced(tex, brace_pos, "{", "}")
                 j = end if end is not None else brace_pos
 
         block = tex[start:j].strip()
@@ -368,32 +396,44 @@ def extract_newcommand_blocks(tex: str) -> Tuple[List[str], str]:
 # LaTeX -> HTML (within sections/problems)
 # --------------------------
 
+@functools.lru_cache(maxsize=256)
+def begin_env_pattern(envname: str) -> re.Pattern:
+    return re.compile(rf"\\begin\{{{re.escape(envname)}\}}")
+
+
+@functools.lru_cache(maxsize=256)
+def end_env_pattern(envname: str) -> re.Pattern:
+    return re.compile(rf"\\end\{{{re.escape(envname)}\}}")
+
+
+@functools.lru_cache(maxsize=256)
+def env_tag_pattern(envname: str) -> re.Pattern:
+    # Matches either \begin{envname} or \end{envname}; group 1 says which.
+    return re.compile(rf"\\(begin|end)\{{{re.escape(envname)}\}}")
+
+
+@functools.lru_cache(maxsize=256)
+def command_arg_pattern(cmd: str) -> re.Pattern:
+    # Matches \cmd{ up to and including the opening brace.
+    return re.compile(rf"\\{re.escape(cmd)}\{{")
+
+
 def find_matching_env(tex: str, begin_pos: int, envname: str) -> int:
     r"""
     Given position at the '\' of \begin{envname}, find matching \end{envname}.
     Returns index of the start of the matching \end{...}. Raises ValueError if not found.
     """
-    # Find the first \begin{envname} at/after begin_pos to sync
-    m0 = re.compile(rf"\\begin\{{{re.escape(envname)}\}}").search(tex, begin_pos)
-    if not m0:
-        raise ValueError(f"begin not found for env {envname}")
-    i = m0.end()
-    depth = 1
-    begin_pat = re.compile(rf"\\begin\{{{re.escape(envname)}\}}")
-    end_pat = re.compile(rf"\\end\{{{re.escape(envname)}\}}")
-    while i < len(tex):
-        mb = begin_pat.search(tex, i)
-        me = end_pat.search(tex, i)
-        if not me:
-            break
-        if mb and mb.start() < me.start():
+    # One walk over both tags; \end tags before the first \begin are ignored.
+    depth = 0
+    for m in env_tag_pattern(envname).finditer(tex, begin_pos):
+        if m.group(1) == "begin":
             depth += 1
-            i = mb.end()
-        else:
+        elif depth:
             depth -= 1
             if depth == 0:
-                return me.start()
-            i = me.end()
+                return m.start()
+    if depth == 0:
+        raise ValueError(f"begin not found for env {envname}")
     raise ValueError(f"end not found for env {envname}")
 
 
@@ -412,20 +452,12 @@ def split_top_level_items(env_body: str) -> List[str]:
     if not m:
         return [env_body.strip()] if env_body.strip() else []
 
-    starts = []
-    while m:
-        starts.append(m.start())
-        m = item_re.search(env_body, m.end())
+    starts = [m.start() for m in item_re.finditer(env_body, m.start())]
 
-    # Now slice between these starts
+    # Now slice between these starts, dropping the leading \item
     for k, st in enumerate(starts):
         en = starts[k + 1] if k + 1 < len(starts) else n
-        chunk = env_body[st:]
-        # remove leading \item
-        chunk = chunk[len(r"\item"):]
-        # up to next item
-        chunk = env_body[st + len(r"\item"):en]
-        items.append(chunk.strip())
+        items.append(env_body[st + len(r"\item"):en].strip())
     return items
 
 
@@ -433,16 +465,18 @@ def convert_lists(tex: str) -> str:
     r"""
     Convert enumerate/itemize environments recursively to <ol>/<ul>.
     """
-    # Convert deepest-first by repeatedly replacing the first occurrence.
+    # Scan left to right; nested lists are handled by recursing on the body.
     begin_list = re.compile(r"\\begin\{(enumerate|itemize)\}")
+    out = []
+    cursor = 0
     while True:
-        m = begin_list.search(tex)
+        m = begin_list.search(tex, cursor)
         if not m:
             break
         env = m.group(1)
         begin_pos = m.start()
         end_pos = find_matching_env(tex, begin_pos, env)
-        end_tag = re.compile(rf"\\end\{{{re.escape(env)}\}}").search(tex, end_pos)
+        end_tag = end_env_pattern(env).match(tex, end_pos)
         if not end_tag:
             break
 
@@ -454,18 +488,25 @@ def convert_lists(tex: str) -> str:
         tag = "ol" if env == "enumerate" else "ul"
         li_html = []
         for it in items:
-            li_html.append(f"<li style=\"margin: 0.35em 0;\">{latex_to_html_inline(it)}</li>")
-        block = f"<{tag} style=\"margin: 0.6em 0 0.6em 1.2em; padding-left: 1.2em;\">{''.join(li_html)}</{tag}>"
+            li_html.append(mark_tag("<li style=\"margin: 0.35em 0;\">") + it + mark_tag("</li>"))
+        block = (
+            mark_tag(f"<{tag} style=\"margin: 0.6em 0 0.6em 1.2em; padding-left: 1.2em;\">")
+            + "".join(li_html)
+            + mark_tag(f"</{tag}>")
+        )
 
-        tex = tex[:begin_pos] + block + tex[end_tag.end():]
-    return tex
+        out.append(tex[cursor:begin_pos])
+        out.append(block)
+        cursor = end_tag.end()
+    out.append(tex[cursor:])
+    return "".join(out)
 
 
 def replace_command_arg_balanced(s: str, cmd: str, open_tag: str, close_tag: str) -> str:
     r"""
     Replace occurrences of \cmd{...} with open_tag ... close_tag, brace-balanced.
     """
-    pat = re.compile(rf"\\{re.escape(cmd)}\{{")
+    pat = command_arg_pattern(cmd)
     i = 0
     out = []
     while True:
@@ -474,21 +515,13 @@ def replace_command_arg_balanced(s: str, cmd: str, open_tag: str, close_tag: str
             out.append(s[i:])
             break
         out.append(s[i:m.start()])
-        j = m.end()  # position after \cmd{
-        depth = 1
-        start_content = j
-        while j < len(s) and depth > 0:
-            if s[j] == "\\" and j + 1 < len(s):
-                j += 2
-                continue
-            if s[j] == "{":
-                depth += 1
-            elif s[j] == "}":
-                depth -= 1
-            j += 1
+        start_content = m.end()  # position after \cmd{
+        j = match_balanced(s, start_content - 1)
+        if j is None:
+            j = len(s) + 1  # unclosed: take the rest
         content = s[start_content:j - 1]  # exclude final }
-        content_html = latex_to_html_inline(content)
-        out.append(open_tag + content_html + close_tag)
+        content_html = convert_inline_commands(content)
+        out.append(mark_tag(open_tag) + content_html + mark_tag(close_tag))
         i = j
     return "".join(out)
 
@@ -506,143 +539,69 @@ def replace_grouped_command(tex: str, cmd: str, open_tag: str, close_tag: str) -
             out.append(tex[i:])
             break
         out.append(tex[i:start])
-        j = start + 1  # at '{'
-        depth = 1
-        while j < len(tex) and tex[j].isspace():
-            j += 1
-        if tex.startswith(r"\%s" % cmd, j):
-            j += len(cmd) + 1
-        while j < len(tex) and tex[j].isspace():
-            j += 1
-        content_start = j
-        while j < len(tex) and depth > 0:
-            if tex[j] == "\\" and j + 1 < len(tex):
-                j += 2
-                continue
-            if tex[j] == "{":
-                depth += 1
-            elif tex[j] == "}":
-                depth -= 1
-            j += 1
+        # content starts after \cmd and any whitespace
+        content_start = WHITESPACE_RE.match(tex, start + len(needle)).end()
+        j = match_balanced(tex, start)
+        if j is None:
+            j = len(tex) + 1  # unclosed: take the rest
         content = tex[content_start:j - 1]
-        content_html = latex_to_html_inline(content)
-        out.append(open_tag + content_html + close_tag)
+        content_html = convert_inline_commands(content)
+        out.append(mark_tag(open_tag) + content_html + mark_tag(close_tag))
         i = j
     return "".join(out)
 
 
-def split_by_math_segments(tex: str) -> List[Tuple[bool, str]]:
+def convert_inline_commands(tex: str) -> str:
     r"""
-    Split into segments (is_math, text) based on \( \) and \[ \].
+    Convert {\footnotesize ...}, \emph{...}, \textbf{...} and \textit{...} to
+    sentinel-marked tags. Arguments only recurse through this function; math
+    and text rules are left to the caller's single pass.
     """
-    segs: List[Tuple[bool, str]] = []
-    i = 0
-    n = len(tex)
-
-    def startswith_at(prefix: str, pos: int) -> bool:
-        return tex.startswith(prefix, pos)
-
-    while i < n:
-        if startswith_at(r"\(", i):
-            # inline math
-            j = i + 2
-            while j < n and not startswith_at(r"\)", j):
-                # skip escaped sequences
-                if tex[j] == "\\" and j + 1 < n:
-                    j += 2
-                else:
-                    j += 1
-            if j >= n:
-                # unmatched, treat as text
-                segs.append((False, tex[i:]))
-                break
-            segs.append((True, tex[i:j + 2]))
-            i = j + 2
-            continue
-
-        if startswith_at(r"\[", i):
-            # display math
-            j = i + 2
-            while j < n and not startswith_at(r"\]", j):
-                if tex[j] == "\\" and j + 1 < n:
-                    j += 2
-                else:
-                    j += 1
-            if j >= n:
-                segs.append((False, tex[i:]))
-                break
-            segs.append((True, tex[i:j + 2]))
-            i = j + 2
-            continue
-
-        # text chunk until next math start
-        j = i
-        while j < n and not startswith_at(r"\(", j) and not startswith_at(r"\[", j):
-            j += 1
-        segs.append((False, tex[i:j]))
-        i = j
-
-    return segs
+    tex = replace_grouped_command(tex, "footnotesize", "<span style=\"font-size: 0.9em;\">", "</span>")
+    tex = replace_command_arg_balanced(tex, "emph", "<em>", "</em>")
+    tex = replace_command_arg_balanced(tex, "textbf", "<strong>", "</strong>")
+    tex = replace_command_arg_balanced(tex, "textit", "<em>", "</em>")
+    return tex
 
 
+@functools.lru_cache(maxsize=4096)
 def latex_to_html_inline(tex: str) -> str:
     r"""
     Convert a LaTeX fragment to HTML (inline), preserving MathJax TeX.
+    Pure in its input, so repeated fragments are rendered once.
     """
-    def protect_tags(text: str) -> Tuple[str, List[str]]:
-        protected: List[str] = []
-
-        def repl(m: re.Match) -> str:
-            protected.append(m.group(0))
-            return f"@@TAG{len(protected) - 1}@@"
-
-        tag_re = re.compile(r"</?(?:em|strong|ol|ul|li|span)\b[^>]*>|<br\s*/?>")
-        return tag_re.sub(repl, text), protected
-
-    def restore_tags(text: str, protected: List[str]) -> str:
-        for i, tag in enumerate(protected):
-            text = text.replace(f"@@TAG{i}@@", tag)
-        return text
-
-    # First convert lists at block-level (it returns HTML for lists)
+    # Each stage runs once over the whole fragment: list structure first, then
+    # inline commands, then math splitting and text rules.
     tex = convert_lists(tex)
+    tex = convert_inline_commands(tex)
 
-    # Convert dollar math to \( \) / \[ \], and wrap math envs
-    tex = wrap_math_environments_in_brackets(tex)
-    tex = convert_dollar_math_to_paren_bracket(tex)
-
-    tex = replace_grouped_command(tex, "footnotesize", "<span style=\"font-size: 0.9em;\">", "</span>")
-
-    # Basic inline formatting commands (balanced braces), before math splitting
-    tex = replace_command_arg_balanced(tex, "emph", "<em>", "</em>")
-    tex = replace_command_arg_balanced(tex, "textbf", "<strong>", "</strong>")
-    tex = replace_command_arg_balanced(tex, "textit", "<em>", "</em>")
-
-    # Split by math segments so we don't clobber TeX with HTML escaping rules too much
-    segs = split_by_math_segments(tex)
-
+    # One pass splits out math ($, $$, \( \), \[ \], align, ...) so text-only
+    # rules never touch TeX; all math is emitted with \( \) / \[ \] delimiters.
     out_parts: List[str] = []
-    for is_math, seg in segs:
-        if is_math:
-            # Escape HTML special chars but keep TeX
-            out_parts.append(html_escape_content(seg))
+    for kind, start, end in tokenize_math(tex):
+        if kind == "inline":
+            out_parts.append(r"\(" + tex[start:end] + r"\)")
+        elif kind == "display":
+            out_parts.append(r"\[" + tex[start:end] + r"\]")
         else:
-            t = seg
+            t = tex[start:end]
             # line breaks
-            t = t.replace(r"\\", "<br/>")
+            t = t.replace(r"\\", mark_tag("<br/>"))
             # Clean whitespace
             t = re.sub(r"[ \t]+\n", "\n", t)
             t = re.sub(r"\n[ \t]+", "\n", t)
-            # Escape HTML without escaping tags we generated.
-            t, protected = protect_tags(t)
-            t = html_escape_content(t)
-            # TeX-style quotes (use entities after escaping so & stays intact)
-            t = t.replace("``", "&ldquo;").replace("''", "&rdquo;")
+            # TeX-style quotes
+            t = t.replace("``", mark_tag("&ldquo;")).replace("''", mark_tag("&rdquo;"))
             t = replace_tex_dashes(t)
-            t = restore_tags(t, protected)
             out_parts.append(t)
 
-    return "".join(out_parts)
+    return finish_marked_html("".join(out_parts))
+
+
+PARA_SPLIT_RE = re.compile(r"\n\s*\n")
+FIRST_TAG_RE = re.compile(r"<(\w+)\b")
+NEWLINE_WS_RE = re.compile(r"\s*\n\s*")
+BLOCK_TAGS = frozenset({"ol", "ul", "div", "h1", "h2", "h3", "blockquote"})
 
 
 def wrap_paragraphs(html: str) -> str:
@@ -650,18 +609,19 @@ def wrap_paragraphs(html: str) -> str:
     Turn plain text chunks into <p>...</p>, leaving existing block tags alone.
     Assumes html may already contain <ol>/<ul>/<li>.
     """
-    chunks = re.split(r"\n\s*\n", html.strip(), flags=re.MULTILINE)
+    chunks = PARA_SPLIT_RE.split(html.strip())
     out = []
     for ch in chunks:
         ch_strip = ch.strip()
         if not ch_strip:
             continue
         # If it begins with a block tag, keep as-is
-        if re.match(r"^\s*<(ol|ul|div|h1|h2|h3|blockquote)\b", ch_strip):
+        m = FIRST_TAG_RE.match(ch_strip)
+        if m and m.group(1) in BLOCK_TAGS:
             out.append(ch_strip)
         else:
             # Replace remaining newlines with spaces
-            ch_strip = re.sub(r"\s*\n\s*", " ", ch_strip)
+            ch_strip = NEWLINE_WS_RE.sub(" ", ch_strip)
             out.append(f"<p style=\"margin: 0.6em 0; line-height: 1.45;\">{ch_strip}</p>")
     return "\n".join(out)
 
@@ -670,7 +630,7 @@ def wrap_paragraphs(html: str) -> str:
 # Document structure parsing
 # --------------------------
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class DocMeta:
     course: str = ""
     author: str = ""
@@ -679,26 +639,18 @@ class DocMeta:
 
 
 def extract_braced_arg(tex: str, cmd: str) -> str:
-    m = re.search(rf"\\{re.escape(cmd)}\{{", tex)
+    m = command_arg_pattern(cmd).search(tex)
     if not m:
         return ""
-    i = m.end()
-    depth = 1
-    start = i
-    while i < len(tex) and depth > 0:
-        if tex[i] == "\\" and i + 1 < len(tex):
-            i += 2
-            continue
-        if tex[i] == "{":
-            depth += 1
-        elif tex[i] == "}":
-            depth -= 1
-        i += 1
-    return tex[start:i - 1].strip()
+    start = m.end()
+    end = match_balanced(tex, start - 1)
+    if end is None:
+        end = len(tex) + 1  # unclosed: take the rest
+    return tex[start:end - 1].strip()
 
 
 def extract_env(tex: str, env: str) -> str:
-    m = re.search(rf"\\begin\{{{re.escape(env)}\}}", tex)
+    m = begin_env_pattern(env).search(tex)
     if not m:
         return ""
     start = m.end()
@@ -707,14 +659,14 @@ def extract_env(tex: str, env: str) -> str:
 
 def remove_env(tex: str, env: str) -> str:
     while True:
-        m = re.search(rf"\\begin\{{{re.escape(env)}\}}", tex)
+        m = begin_env_pattern(env).search(tex)
         if not m:
             return tex
         end = find_matching_env(tex, m.start(), env)
-        end_tag = re.search(rf"\\end\{{{re.escape(env)}\}}", tex[end:])
+        end_tag = end_env_pattern(env).match(tex, end)
         if not end_tag:
             return tex
-        tex = tex[:m.start()] + tex[end + end_tag.end():]
+        tex = tex[:m.start()] + tex[end_tag.end():]
 
 
 def body_between_document(tex: str) -> str:
@@ -734,53 +686,36 @@ def parse_sections_and_problems(body: str) -> List[Tuple[str, str]]:
     i = 0
     n = len(body)
 
-    # We'll search for next \section or \begin{problem}/\begin{problem*}
-    marker_re = re.compile(r"\\section\{|\\begin\{problem\*?\}")
-
-    while True:
-        m = marker_re.search(body, i)
-        if not m:
-            break
+    for m in SECTION_OR_PROBLEM_RE.finditer(body):
+        # Markers inside a section title or problem we already consumed
+        if m.start() < i:
+            continue
         if m.start() > i:
             inter = body[i:m.start()].strip()
             if inter:
                 blocks.append(("text", inter))
 
-        if body.startswith(r"\section{", m.start()):
+        if m.group(1):
             # parse braced arg
-            j = m.end()
-            depth = 1
-            start = j
-            while j < n and depth > 0:
-                if body[j] == "\\" and j + 1 < n:
-                    j += 2
-                    continue
-                if body[j] == "{":
-                    depth += 1
-                elif body[j] == "}":
-                    depth -= 1
-                j += 1
+            start = m.end()
+            j = match_balanced(body, start - 1)
+            if j is None:
+                j = n + 1
             title = body[start:j - 1].strip()
             blocks.append(("section", title))
             i = j
             continue
 
         # problem or problem*
-        pb = re.match(r"\\begin\{(problem\*?)\}", body[m.start():])
-        if pb:
-            env = pb.group(1)  # 'problem' or 'problem*'
-            begin_pos = m.start()
-            end_pos = find_matching_env(body, begin_pos, env)
-            end_tag = re.compile(rf"\\end\{{{re.escape(env)}\}}").search(body, end_pos)
-            if not end_tag:
-                # malformed; stop
-                break
-            content = body[m.start() + len(pb.group(0)):end_pos].strip()
-            blocks.append((env, content))
-            i = end_tag.end()
-            continue
-
-        i = m.end()
+        env = m.group(2)
+        end_pos = find_matching_env(body, m.start(), env)
+        end_tag = end_env_pattern(env).match(body, end_pos)
+        if not end_tag:
+            # malformed; stop
+            break
+        content = body[m.end():end_pos].strip()
+        blocks.append((env, content))
+        i = end_tag.end()
 
     tail = body[i:].strip()
     if tail:
@@ -794,8 +729,7 @@ def parse_sections_and_problems(body: str) -> List[Tuple[str, str]]:
 
 def build_label_map_for_tex(tex_path: str) -> dict[str, str]:
     base_dir = os.path.dirname(os.path.abspath(tex_path)) or "."
-    raw = read_text(tex_path)
-    raw = strip_comments(raw)
+    raw = read_stripped(tex_path)
     raw = resolve_inputs(raw, base_dir)
     _, without_macros = extract_newcommand_blocks(raw)
     body = body_between_document(without_macros)
@@ -872,12 +806,11 @@ def render_html(
     macro_block = ""
     if macros:
         # Keep original TeX, but escape for HTML
-        joined = " ".join(m.strip() for m in macros if m.strip())
+        joined = " ".join(filter(None, (m.strip() for m in macros)))
         # Put macros in a hidden inline-math block so MathJax reads them.
         # MathJax v3 will parse macros appearing anywhere before use.
-        macro_block = (
-            f"<span style=\"display:none;\">{html_escape_content(r'\(' + joined + r'\)')}</span>"
-        )
+        macro_tex = html_escape_content(r"\(" + joined + r"\)")
+        macro_block = f"<span style=\"display:none;\">{macro_tex}</span>"
 
     # Header text
     hwtitle = meta.hwtitle or meta.course or "Problem Set"
@@ -892,33 +825,34 @@ def render_html(
         header_sub_html = replace_tex_dashes(html_escape_content(course or term))
 
     # Begin HTML
-    parts: List[str] = []
-    parts.append("<!doctype html>")
-    parts.append("<html>")
-    parts.append("<head>")
-    parts.append("<meta charset=\"utf-8\"/>")
-    parts.append("<meta name=\"viewport\" content=\"width=device-width, initial-scale=1\"/>")
-    # MathJax (Canvas typically allows external JS in HTML uploads; if not, remove this line)
-    parts.append("<script defer src=\"https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js\"></script>")
-    parts.append("<title>" + header_title + "</title>")
-    parts.append("</head>")
-    parts.append("<body>")
-    parts.append(f"<div style=\"{page_style}\">")
-    parts.append(macro_block)
+    out = io.StringIO()
+    # MathJax (Canvas typically allows external JS in HTML uploads; if not, drop the script tag)
+    out.write(f"""<!doctype html>
+<html>
+<head>
+<meta charset="utf-8"/>
+<meta name="viewport" content="width=device-width, initial-scale=1"/>
+<script defer src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
+<title>{header_title}</title>
+</head>
+<body>
+<div style="{page_style}">
+{macro_block}
+""")
 
     # Title area (includes epigraph)
-    parts.append(f"<div style=\"{header_style}\">")
-    parts.append(f"<h1 style=\"{title_style}\">{header_title}</h1>")
+    out.write(f"<div style=\"{header_style}\">\n")
+    out.write(f"<h1 style=\"{title_style}\">{header_title}</h1>\n")
     if header_sub_html:
-        parts.append(f"<div style=\"{subtitle_style}\">{header_sub_html}</div>")
+        out.write(f"<div style=\"{subtitle_style}\">{header_sub_html}</div>\n")
     if quote_html or byline_html:
-        parts.append(f"<div style=\"{epi_style}\">")
+        out.write(f"<div style=\"{epi_style}\">\n")
         if quote_html:
-            parts.append(f"<div style=\"font-style: italic;\">{quote_html}</div>")
+            out.write(f"<div style=\"font-style: italic;\">{quote_html}</div>\n")
         if byline_html:
-            parts.append(f"<div style=\"margin-top: 8px;\">&mdash; {byline_html}</div>")
-        parts.append("</div>")
-    parts.append("</div>")
+            out.write(f"<div style=\"margin-top: 8px;\">&mdash; {byline_html}</div>\n")
+        out.write("</div>\n")
+    out.write("</div>\n")
 
     def replace_refs(tex: str) -> str:
         def repl(m: re.Match) -> str:
@@ -932,14 +866,14 @@ def render_html(
             payload = LABEL_RE.sub("", payload)
             payload = replace_refs(payload)
             title = latex_to_html_inline(payload)
-            parts.append(f"<h1 style=\"{section_style}\">{title}</h1>")
+            out.write(f"<h1 style=\"{section_style}\">{title}</h1>\n")
             continue
         if kind == "text":
             payload = LABEL_RE.sub("", payload)
             payload = replace_refs(payload)
             content_html = latex_to_html_inline(payload)
             content_html = wrap_paragraphs(content_html)
-            parts.append(content_html)
+            out.write(content_html + "\n")
             continue
 
         if kind in ("problem", "problem*"):
@@ -951,17 +885,16 @@ def render_html(
             content_html = latex_to_html_inline(payload)
             content_html = wrap_paragraphs(content_html)
 
-            parts.append(f"<div style=\"{card_style}\">")
-            parts.append(f"<div style=\"{card_title_style}\">{html_escape_content(pid)}{html_escape_content(star)}</div>")
-            parts.append(content_html)
-            parts.append("</div>")
+            out.write(f"""<div style="{card_style}">
+<div style="{card_title_style}">{html_escape_content(pid)}{html_escape_content(star)}</div>
+{content_html}
+</div>
+""")
             continue
 
-    parts.append("</div>")
-    parts.append("</body>")
-    parts.append("</html>")
+    out.write("</div>\n</body>\n</html>")
 
-    return "\n".join(parts)
+    return out.getvalue()
 
 
 # --------------------------
@@ -976,8 +909,7 @@ def main() -> None:
 
     tex_path = args.texfile
     base_dir = os.path.dirname(os.path.abspath(tex_path)) or "."
-    raw = read_text(tex_path)
-    raw = strip_comments(raw)
+    raw = read_stripped(tex_path)
     raw = resolve_inputs(raw, base_dir)
 
     # Extract macros from full expanded source
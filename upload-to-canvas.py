@@ -8,20 +8,40 @@ Usage:
   python upload_assignment_html_stdlib.py set01.html \
     https://osu.instructure.com/courses/205092/assignments/5236217/
 
+  python upload_assignment_html_stdlib.py --batch manifest.tsv
+
 Notes:
+- With --watch, the script keeps running after the upload and re-uploads
+  each file when it changes, reusing the open connections.
+- With --batch, each manifest line is "html_file<TAB>assignment_url"; uploads
+  to the same host share one connection.
 - This REPLACES the assignment description with the file contents.
 """
 
 import argparse
+import functools
+import gzip
 import json
+import mmap
 import os
+import re
 import sys
-from html.parser import HTMLParser
-from urllib.parse import urlparse, urlencode
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError, URLError
+import time
+from typing import NamedTuple
+from http.client import (BadStatusLine, HTTPConnection, HTTPException, HTTPSConnection,
+                         RemoteDisconnected)
+from urllib.parse import quote_from_bytes, urlparse, urlencode
+
+# Form key for the description field, already percent-encoded
+DESCRIPTION_FIELD = b"assignment%5Bdescription%5D="
+# Smaller bodies are not worth compressing
+GZIP_MIN_BYTES = 1024
 
+_BODY_OPEN = re.compile(rb"<body\b[^>]*>", re.I)
+_BODY_CLOSE = re.compile(rb"</body\s*>", re.I)
 
+
+@functools.lru_cache(maxsize=256)
 def parse_assignment_url(url: str):
     p = urlparse(url)
     if not p.scheme or not p.netloc:
@@ -29,164 +49,317 @@ def parse_assignment_url(url: str):
 
     parts = [x for x in p.path.split("/") if x]
     # Expect: /courses/{course_id}/assignments/{assignment_id}
+    # One walk over the path; the first occurrence of each name wins.
+    course_id = assignment_id = None
     try:
-        i = parts.index("courses")
-        course_id = parts[i + 1]
-        j = parts.index("assignments")
-        assignment_id = parts[j + 1]
-    except (ValueError, IndexError) as e:
+        for idx, token in enumerate(parts):
+            if course_id is None and token == "courses":
+                course_id = parts[idx + 1]
+            elif assignment_id is None and token == "assignments":
+                assignment_id = parts[idx + 1]
+            if course_id is not None and assignment_id is not None:
+                break
+    except IndexError:
+        course_id = assignment_id = None
+    if course_id is None or assignment_id is None:
         raise ValueError(
             f"URL path must look like /courses/<course_id>/assignments/<assignment_id>, got: {p.path}"
-        ) from e
+        )
 
     base = f"{p.scheme}://{p.netloc}"
     return base, course_id, assignment_id
 
 
-def http_json(method: str, url: str, token: str, data_dict=None, timeout=60):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json",
-    }
+class CanvasClient:
+    """
+    Talks to one Canvas host over a single persistent connection, so the
+    GET and PUT of an upload share one TCP/TLS session.
+    """
+
+    def __init__(self, base_url: str, token: str, timeout=60, gzip_upload=False):
+        p = urlparse(base_url)
+        conn_cls = HTTPSConnection if p.scheme == "https" else HTTPConnection
+        self.base_url = base_url
+        self.conn = conn_cls(p.netloc, timeout=timeout)
+        self.gzip_upload = gzip_upload
+        # Built once; requests pass these dicts through without copying
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+        }
+        self.form_headers = {
+            **self.headers,
+            # Canvas accepts x-www-form-urlencoded for updates
+            "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
+        }
+
+    def close(self):
+        self.conn.close()
+
+    def request_json(self, method: str, path: str, data_dict=None, body=None, timeout=60):
+        """
+        Send a request and decode the JSON reply. Form data is given either as
+        data_dict or as an already url-encoded body (bytes or bytearray).
+        """
+        url = self.base_url + path
 
-    data_bytes = None
-    if data_dict is not None:
-        # Canvas accepts x-www-form-urlencoded for updates
-        body = urlencode(data_dict).encode("utf-8")
         data_bytes = body
-        headers["Content-Type"] = "application/x-www-form-urlencoded; charset=utf-8"
+        if data_dict is not None:
+            if data_dict.keys() == {"assignment[description]"}:
+                data_bytes = encode_description(data_dict["assignment[description]"].encode("utf-8"))
+            else:
+                data_bytes = urlencode(data_dict).encode("utf-8")
+        # http.client fills in Content-Length for bytes-like bodies
+        headers = self.headers if data_bytes is None else self.form_headers
+        if self.gzip_upload and data_bytes is not None and len(data_bytes) > GZIP_MIN_BYTES:
+            data_bytes = gzip.compress(data_bytes, compresslevel=6)
+            headers = {**headers, "Content-Encoding": "gzip"}
+
+        self.conn.timeout = timeout
+        if self.conn.sock is not None:
+            self.conn.sock.settimeout(timeout)
+
+        for attempt in range(2):
+            # The server may drop a kept-alive connection while it sits idle;
+            # http.client reconnects after close(), so retry such a failure once.
+            reused = self.conn.sock is not None
+            try:
+                self.conn.request(method, path, body=data_bytes, headers=headers)
+                resp = self.conn.getresponse()
+                raw = resp.read()
+                if resp.getheader("Content-Encoding", "").lower() == "gzip":
+                    raw = gzip.decompress(raw)
+                raw = raw.decode("utf-8", errors="replace")
+                break
+            except (OSError, EOFError, HTTPException) as e:
+                self.conn.close()
+                stale = isinstance(e, (RemoteDisconnected, BadStatusLine, ConnectionResetError, BrokenPipeError))
+                if attempt == 0 and reused and stale:
+                    continue
+                raise RuntimeError(f"{method} {url} -> Network error: {e}") from e
+
+        if resp.status >= 400:
+            raise RuntimeError(f"{method} {url} -> HTTP {resp.status}\n{raw}")
+        if raw.strip() == "":
+            return {}
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise RuntimeError(f"{method} {url} -> Could not parse JSON response") from e
+
+
+def encode_description(html: bytes) -> bytearray:
+    """
+    Form-encode html as the assignment description. Only the value needs
+    quoting, so this skips urlencode and makes one quote_from_bytes pass.
+    """
+    body = bytearray(DESCRIPTION_FIELD)
+    body += quote_from_bytes(html, safe="").encode("ascii")
+    return body
+
+
+def extract_body_html(data):
+    """
+    Return (contents of <body>, True), passed through verbatim, or (data, False)
+    when the document has no <body> tag. An unclosed <body> runs to the end.
+    data may be bytes or an mmap; the result is always bytes.
+    """
+    m1 = _BODY_OPEN.search(data)
+    if not m1:
+        return bytes(data), False
+    m2 = _BODY_CLOSE.search(data, m1.end())
+    return data[m1.end():m2.start() if m2 else len(data)], True
+
+
+def read_body(html_file: str, extract: bool = True):
+    """
+    Extract the <body> of html_file as bytes, mapping the file rather than
+    reading it so only the body itself is copied out of the page cache.
+    With extract=False the whole file is returned.
+    """
+    with open(html_file, "rb") as f:
+        if not extract:
+            return f.read(), False
+        # mmap cannot map an empty file, and behaves differently on Windows
+        if os.name == "nt" or os.fstat(f.fileno()).st_size == 0:
+            return extract_body_html(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return extract_body_html(mm)
+
+
+class Upload(NamedTuple):
+    html_file: str
+    base_url: str
+    api_path: str
+    html_bytes: bytes
+    used_body: bool
+
+
+def prepare_upload(html_file: str, assignment_url: str, extract: bool = True) -> Upload:
+    base_url, course_id, assignment_id = parse_assignment_url(assignment_url)
+    api_path = f"/api/v1/courses/{course_id}/assignments/{assignment_id}"
+
+    try:
+        html_bytes, used_body = read_body(html_file, extract)
+    except OSError as e:
+        print(f"ERROR: Could not read {html_file}: {e}", file=sys.stderr)
+        sys.exit(2)
+    return Upload(html_file, base_url, api_path, html_bytes, used_body)
 
-    req = Request(url, method=method, headers=headers, data=data_bytes)
 
+def read_manifest(path: str):
+    """
+    Yield (html_file, assignment_url) pairs from a tab-separated manifest.
+    Blank lines and lines starting with # are skipped.
+    """
     try:
-        with urlopen(req, timeout=timeout) as resp:
-            raw = resp.read().decode("utf-8", errors="replace")
-            if raw.strip() == "":
-                return {}
-            return json.loads(raw)
-    except HTTPError as e:
-        err_body = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"{method} {url} -> HTTP {e.code}\n{err_body}") from e
-    except URLError as e:
-        raise RuntimeError(f"{method} {url} -> Network error: {e}") from e
-    except json.JSONDecodeError as e:
-        raise RuntimeError(f"{method} {url} -> Could not parse JSON response") from e
-
-
-class BodyExtractor(HTMLParser):
-    def __init__(self):
-        super().__init__(convert_charrefs=False)
-        self.in_body = False
-        self.seen_body = False
-        self.parts = []
-
-    def handle_starttag(self, tag, attrs):
-        if tag.lower() == "body":
-            self.in_body = True
-            self.seen_body = True
-            return
-        if self.in_body:
-            self.parts.append(self._format_starttag(tag, attrs, closed=False))
-
-    def handle_startendtag(self, tag, attrs):
-        if self.in_body:
-            self.parts.append(self._format_starttag(tag, attrs, closed=True))
-
-    def handle_endtag(self, tag):
-        if tag.lower() == "body":
-            self.in_body = False
-            return
-        if self.in_body:
-            self.parts.append(f"</{tag}>")
-
-    def handle_data(self, data):
-        if self.in_body:
-            self.parts.append(data)
-
-    def handle_entityref(self, name):
-        if self.in_body:
-            self.parts.append(f"&{name};")
-
-    def handle_charref(self, name):
-        if self.in_body:
-            self.parts.append(f"&#{name};")
-
-    def handle_comment(self, data):
-        if self.in_body:
-            self.parts.append(f"<!--{data}-->")
-
-    def _format_starttag(self, tag, attrs, closed: bool):
-        if not attrs:
-            return f"<{tag}{' /' if closed else ''}>"
-        attr_strs = []
-        for key, value in attrs:
-            if value is None:
-                attr_strs.append(key)
-            else:
-                escaped = value.replace('"', "&quot;")
-                attr_strs.append(f'{key}="{escaped}"')
-        attr_section = " ".join(attr_strs)
-        return f"<{tag} {attr_section}{' /' if closed else ''}>"
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        print(f"ERROR: Could not read {path}: {e}", file=sys.stderr)
+        sys.exit(2)
 
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        fields = line.split("\t")
+        if len(fields) != 2:
+            print(f"ERROR: {path}:{lineno}: expected html_file<TAB>assignment_url", file=sys.stderr)
+            sys.exit(2)
+        yield fields[0].strip(), fields[1].strip()
+
+
+def run_uploads(client: CanvasClient, uploads, dry_run: bool, verify: bool):
+    """
+    Upload everything for one host over the client's connection: every GET
+    first, then every PUT, so reads and writes are not interleaved. The GETs
+    are only made for --verify and --dry-run.
+    """
+    labelled = len(uploads) > 1
+    for up in uploads:
+        if labelled:
+            print(f"== {up.html_file}")
+        if verify or dry_run:
+            # Fetch current assignment (useful sanity check)
+            assignment = client.request_json("GET", up.api_path, timeout=30)
+            title = assignment.get("name", "(no name)")
+            print(f"Assignment: {title}")
+        else:
+            print(f"Assignment: {client.base_url}{up.api_path}")
+        if up.used_body:
+            print("Using <body> contents only.")
+        print(f"Replacing description with {len(up.html_bytes)} bytes from {up.html_file}")
+
+    if dry_run:
+        print("Dry run: not updating.")
+        return
 
-def extract_body_html(html: str):
-    parser = BodyExtractor()
-    parser.feed(html)
-    parser.close()
-    if parser.seen_body:
-        return "".join(parser.parts), True
-    return html, False
+    for up in uploads:
+        # Same connection as the GETs, so no further TLS handshakes
+        updated = client.request_json(
+            "PUT",
+            up.api_path,
+            body=encode_description(up.html_bytes),
+            timeout=60,
+        )
+        if labelled:
+            print(f"== {up.html_file}")
+        print("Update successful.")
+        print(f"Updated description length: {len(updated.get('description') or '')}")
+
+
+def file_stamp(path: str):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def watch_uploads(clients, pairs, args):
+    """
+    Poll the files in pairs and re-upload each one whose modification time or
+    size changes, reusing the open client for its host. Runs until Ctrl-C.
+    """
+    stamps = [file_stamp(html_file) for html_file, _ in pairs]
+    print(f"Watching {len(pairs)} file(s) every {args.interval:g}s; press Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(args.interval)
+            by_host = {}
+            for i, (html_file, assignment_url) in enumerate(pairs):
+                stamp = file_stamp(html_file)
+                # A missing file is usually an editor in the middle of saving
+                if stamp is None or stamp == stamps[i]:
+                    continue
+                stamps[i] = stamp
+                up = prepare_upload(html_file, assignment_url, args.extract_body)
+                by_host.setdefault(up.base_url, []).append(up)
+
+            for base_url, uploads in by_host.items():
+                try:
+                    run_uploads(clients[base_url], uploads, args.dry_run, args.verify)
+                except RuntimeError as e:
+                    # Keep watching; the next save will try again
+                    print(f"ERROR: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
 
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("html_file", help="Path to HTML file (e.g., set01.html)")
-    ap.add_argument("assignment_url", help="Canvas assignment URL")
+    ap.add_argument("html_file", nargs="?", help="Path to HTML file (e.g., set01.html)")
+    ap.add_argument("assignment_url", nargs="?", help="Canvas assignment URL")
+    ap.add_argument("--batch", metavar="MANIFEST",
+                    help="Tab-separated file of html_file<TAB>assignment_url lines to upload together")
+    ap.add_argument("--extract-body", action=argparse.BooleanOptionalAction, default=True,
+                    help="Upload only the contents of <body> when the file has one (default: on)")
     ap.add_argument("--dry-run", action="store_true",
                     help="Show what would happen, but don't update")
+    ap.add_argument("--verify", action="store_true",
+                    help="Fetch each assignment and show its name before updating")
+    ap.add_argument("--gzip-upload", action="store_true",
+                    help="Gzip the PUT body (the server must accept Content-Encoding: gzip)")
+    ap.add_argument("--watch", action="store_true",
+                    help="After uploading, keep running and re-upload files whenever they change")
+    ap.add_argument("--interval", type=float, default=1.0,
+                    help="Seconds between checks for changed files with --watch (default: 1)")
     args = ap.parse_args()
 
+    if args.batch:
+        if args.html_file or args.assignment_url:
+            ap.error("give either --batch or html_file and assignment_url, not both")
+        pairs = list(read_manifest(args.batch))
+    elif args.html_file and args.assignment_url:
+        pairs = [(args.html_file, args.assignment_url)]
+    else:
+        ap.error("html_file and assignment_url are required without --batch")
+
     token = os.environ.get("CANVAS_ACCESS_TOKEN")
     if not token:
         print("ERROR: CANVAS_ACCESS_TOKEN is not set in the environment.", file=sys.stderr)
         sys.exit(2)
 
-    base_url, course_id, assignment_id = parse_assignment_url(args.assignment_url)
-    api = f"{base_url}/api/v1/courses/{course_id}/assignments/{assignment_id}"
+    # One client, and so one connection, per Canvas host
+    by_host = {}
+    for html_file, assignment_url in pairs:
+        up = prepare_upload(html_file, assignment_url, args.extract_body)
+        by_host.setdefault(up.base_url, []).append(up)
 
-    # Read HTML file
+    clients = {
+        base_url: CanvasClient(base_url, token, gzip_upload=args.gzip_upload)
+        for base_url in by_host
+    }
     try:
-        with open(args.html_file, "r", encoding="utf-8") as f:
-            new_html = f.read()
-    except OSError as e:
-        print(f"ERROR: Could not read {args.html_file}: {e}", file=sys.stderr)
-        sys.exit(2)
-
-    new_html, used_body = extract_body_html(new_html)
-
-    # Fetch current assignment (useful sanity check)
-    assignment = http_json("GET", api, token, timeout=30)
-    title = assignment.get("name", "(no name)")
-    print(f"Assignment: {title}")
-    if used_body:
-        print("Using <body> contents only.")
-    print(f"Replacing description with {len(new_html)} characters from {args.html_file}")
-
-    if args.dry_run:
-        print("Dry run: not updating.")
-        return
-
-    updated = http_json(
-        "PUT",
-        api,
-        token,
-        data_dict={"assignment[description]": new_html},
-        timeout=60,
-    )
-
-    print("Update successful.")
-    print(f"Updated description length: {len(updated.get('description') or '')}")
+        for base_url, uploads in by_host.items():
+            run_uploads(clients[base_url], uploads, args.dry_run, args.verify)
+        if args.watch:
+            watch_uploads(clients, pairs, args)
+    finally:
+        for client in clients.values():
+            client.close()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())